@@ -1,4 +1,7 @@
 import asyncio
+import struct
+import time
+from collections import deque
 from sys import exit
 
 from bleak import BleakClient, uuids
@@ -11,17 +14,40 @@ CIRCLE = 8
 SELECT = 2
 START = 1
 
+KEEPALIVE = 1.0  # s, the packet is repeated that often while no key changes
+EXTENDED = True  # send sequence numbered packets and measure the latency from their echoes
+LOSS_TIMEOUT = 2.0  # s, a packet not echoed by then is lost
+REPORT = 5.0  # s between latency reports
+TELEMETRY = 0x5AA5  # record magics of the telemetry stream, see pico/telemetry.py
+TELEMETRY_SIZE = 60
+ECHO = 0x5AA6
+ECHO_RECORD = "<HHIHH"  # magic, seq, host ms, frame, ms from receipt to the frame
+ECHO_SIZE = struct.calcsize(ECHO_RECORD)
+
 active_keys = []
+loop = None  # event loop of the BLE tasks, see connect_and_communicate()
+keys_changed = None  # asyncio.Event, set from the keyboard thread
+pending = {}  # seq -> host ms of the packets not echoed yet
+latencies = deque(maxlen=1000)  # ms from sending a packet to the frame it took effect at
+stats = {"echoed": 0, "lost": 0}
 
 
 def hooke(e):
     if e.event_type == 'down':
         if e.name not in active_keys:
             active_keys.append(e.name)
+            notify_change()
         elif e.name == 'esc':
             exit(0)  # Successful exit
     elif e.event_type == 'up' and e.name in active_keys:
         active_keys.remove(e.name)
+        notify_change()
+
+
+def notify_change():
+    # keyboard hooks run in their own thread, keys before the connection need no packet
+    if keys_changed is not None:
+        loop.call_soon_threadsafe(keys_changed.set)
 
 
 keyboard.hook(hooke, suppress=True)
@@ -36,72 +62,140 @@ WRITE_CHARACTERISTIC_UUID = uuids.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E") #
 READ_CHARACTERISTIC_UUID = uuids.UUID("6E400003-B5A3-F393-E0A9-E50E24DCCA9E")  # Central reads here
 
 def pack_prepare(active_keys):
-    null_pack = [b'\xff', b'\x01', b'\x02', b'\x01', b'\x02', b'\x00', b'\x00', b'\x00']
-    null_pack[5] = 0  # keys
-    null_pack[6] = 0  # vector of direction (speed: -7..+7; angle: 0..360 degrees)
+    keys = 0
+    vector = 0  # vector of direction (speed: 0..7; angle: 0..360 degrees in 15 degrees steps)
 
     if "r" in active_keys:
-        null_pack[5] = null_pack[5] | TRIANGLE
+        keys |= TRIANGLE
     if "w" in active_keys:
         if "a" in active_keys:
-            null_pack[6] = null_pack[6] | 9
+            vector = 9
         elif "d" in active_keys:
-            null_pack[6] = null_pack[6] | 3
+            vector = 3
         else:
-            null_pack[6] = null_pack[6] | 6
+            vector = 6
     elif "s" in active_keys:
         if "a" in active_keys:
-            null_pack[6] = null_pack[6] | 15
+            vector = 15
         elif "d" in active_keys:
-            null_pack[6] = null_pack[6] | 21
+            vector = 21
         else:
-            null_pack[6] = null_pack[6] | 18
+            vector = 18
     elif "a" in active_keys:
-        null_pack[6] = null_pack[6] | 24
+        vector = 24
     elif "d" in active_keys:
-        null_pack[6] = null_pack[6] | 12
+        vector = 12
     if len(active_keys) > 0:
-        null_pack[6] = ((null_pack[6] << 3) | 7)
-    null_pack[5] = null_pack[5].to_bytes(1, 'big')
-    null_pack[6] = null_pack[6].to_bytes(1, 'big')
-    print(null_pack)
-    res = b''.join(null_pack)
-    print(res)
-    return res
+        vector = ((vector << 3) | 7) & 0xFF
+    return bytes((0xFF, 0x01, 0x02, 0x01, 0x02, keys, vector, 0x00))
 
 
-async def send_data_task(client):
-    """Send data to the peripheral device."""
-    while True:
-        message = f"{active_keys}".encode("utf-8")
-        # print(f"Central sending: {message}")
-        await client.write_gatt_char(WRITE_CHARACTERISTIC_UUID, pack_prepare(active_keys))
-        await asyncio.sleep(0.5)
+def now_ms():
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
 
-async def receive_data_task(client):
-    """Receive data from the peripheral device."""
+def extend(packet, seq, stamp):
+    # 8 data bytes: buttons, vector, seq (uint16), host ms (uint32), see pico/dabble.py
+    return packet[:4] + struct.pack("<BBBHI", 8, packet[5], packet[6], seq, stamp) + b"\x00"
+
+
+async def send_data_task(client):
+    """Send the packet to the peripheral as soon as a key changes, and as a keepalive."""
+    char = client.services.get_characteristic(WRITE_CHARACTERISTIC_UUID)
+    # write without response does not wait for the round trip
+    response = "write-without-response" not in char.properties
+    last = None
+    last_sent = 0
+    seq = 0
     while True:
         try:
-            # print("Central waiting for data from peripheral...")
-            response = await client.read_gatt_char(READ_CHARACTERISTIC_UUID)
-            print(f"Central received: {response.decode('utf-8')}")
-            await asyncio.sleep(1)
-        except Exception as e:
-            print(f"Error receiving data: {e}")
-            break
+            await asyncio.wait_for(keys_changed.wait(), KEEPALIVE)
+        except asyncio.TimeoutError:
+            pass
+        keys_changed.clear()
+        packet = pack_prepare(active_keys)
+        if packet == last and loop.time() - last_sent < KEEPALIVE:
+            continue  # the same keys again before the keepalive is due
+        last = packet
+        if EXTENDED:
+            stamp = now_ms()
+            packet = extend(packet, seq, stamp)
+            pending[seq] = stamp
+            seq = (seq + 1) & 0xFFFF
+        await client.write_gatt_char(WRITE_CHARACTERISTIC_UUID, packet, response=response)
+        last_sent = loop.time()
+
+def on_echo(seq, stamp, frame, age):
+    sent = pending.pop(seq, None)
+    if sent != stamp:
+        return  # timed out already, or not a packet of this session
+    rtt = (now_ms() - stamp) & 0xFFFFFFFF
+    # the way back is taken as long as the way there
+    latencies.append((rtt + age) / 2)
+    stats["echoed"] += 1
+
+
+def receiver():
+    """Notification handler: finds the records of the telemetry stream by their magic."""
+    stream = bytearray()
+
+    def on_notify(_, data):
+        stream.extend(data)
+        i = 0
+        while len(stream) - i >= 2:
+            magic = stream[i] | stream[i + 1] << 8
+            size = TELEMETRY_SIZE if magic == TELEMETRY else ECHO_SIZE if magic == ECHO else 0
+            if not size:
+                i += 1  # lost notification, look for the next record
+                continue
+            if len(stream) - i < size:
+                break
+            if magic == ECHO:
+                on_echo(*struct.unpack_from(ECHO_RECORD, stream, i)[1:])
+            i += size
+        del stream[:i]
+
+    return on_notify
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def report_task():
+    """Print the command to motion latency and the loss of the sequence numbered packets."""
+    while True:
+        await asyncio.sleep(REPORT)
+        old = (now_ms() - int(LOSS_TIMEOUT * 1000)) & 0xFFFFFFFF
+        for seq, stamp in list(pending.items()):
+            if (old - stamp) & 0xFFFFFFFF < 0x80000000:
+                del pending[seq]
+                stats["lost"] += 1
+        done = stats["echoed"] + stats["lost"]
+        loss = 100 * stats["lost"] / done if done else 0
+        if latencies:
+            values = sorted(latencies)
+            print(f"latency ms p50 {percentile(values, 50):.0f} p95 {percentile(values, 95):.0f} "
+                  f"p99 {percentile(values, 99):.0f}, loss {loss:.1f}% of {done}")
+        elif done:
+            print(f"no echo, loss {loss:.1f}% of {done}")
 
 async def connect_and_communicate(address):
     """Connect to the peripheral and manage data exchange."""
     print(f"Connecting to {address}...")
 
+    global loop, keys_changed
+    loop = asyncio.get_running_loop()
+    keys_changed = asyncio.Event()  # last: notify_change() checks it
     async with BleakClient(address) as client:
         print(f"Connected: {client.is_connected}")
 
-        # Create tasks for sending and receiving data
+        await client.start_notify(READ_CHARACTERISTIC_UUID, receiver())
+
+        # Create tasks for sending data and reporting the latency
         tasks = [
             asyncio.create_task(send_data_task(client)),
-            asyncio.create_task(receive_data_task(client)),
-
+            asyncio.create_task(report_task()),
         ]
         await asyncio.gather(*tasks)
 
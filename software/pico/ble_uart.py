@@ -13,7 +13,10 @@ from micropython import const
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
 _IRQ_GATTS_WRITE = const(3)
+_IRQ_MTU_EXCHANGED = const(21)
+_ATT_HEADER = const(3)  # bytes of a notification that are not payload
 
+_FLAG_WRITE_NO_RESPONSE = const(0x0004)
 _FLAG_WRITE = const(0x0008)
 _FLAG_NOTIFY = const(0x0010)
 
@@ -24,7 +27,7 @@ _UART_TX = (
 )
 _UART_RX = (
     bluetooth.UUID("6E400002-B5A3-F393-E0A9-E50E24DCCA9E"),
-    _FLAG_WRITE,
+    _FLAG_WRITE | _FLAG_WRITE_NO_RESPONSE,
 )
 _UART_SERVICE = (
     _UART_UUID,
@@ -44,10 +47,80 @@ START = 1
 RADIUS = 0
 ANGLE = 0
 
+class RingBuffer:
+    """
+    Byte FIFO in a preallocated bytearray, one writer and one reader.
+    write() copies byte by byte and allocates nothing, so it is safe in the BLE IRQ.
+    When full the new bytes are dropped and counted in overflows
+    """
+
+    def __init__(self, size=256):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._size = size
+        self._head = 0  # next byte to write, only write() moves it
+        self._tail = 0  # next byte to read, only the readers move it
+        self.overflows = 0
+
+    def any(self):
+        return (self._head - self._tail) % self._size
+
+    def write(self, data):
+        buf = self._buf
+        size = self._size
+        head = self._head
+        tail = self._tail
+        for b in data:
+            nxt = head + 1 if head + 1 < size else 0
+            if nxt == tail:  # one slot stays free to tell full from empty
+                self.overflows += 1
+                break
+            buf[head] = b
+            head = nxt
+        self._head = head
+
+    def peek(self):
+        """
+        Returns:
+            memoryview: bytes from the read position up to the end of the data
+            or of the buffer, whichever is first. Nothing is consumed
+        """
+        head = self._head
+        tail = self._tail
+        return self._mv[tail:head if head >= tail else self._size]
+
+    def consume(self, n):
+        """
+        Drops n bytes (at most all of them) from the read side
+        """
+        n = min(n, self.any())
+        self._tail = (self._tail + n) % self._size
+
+    def readinto(self, buf, n=None):
+        """
+        Moves up to n bytes (len(buf) by default) into buf
+
+        Returns:
+            int: bytes read
+        """
+        n = min(len(buf) if n is None else n, self.any())
+        done = 0
+        while done < n:
+            chunk = self.peek()
+            k = min(len(chunk), n - done)
+            buf[done:done + k] = chunk[:k]
+            self.consume(k)
+            done += k
+        return done
+
+
 class BLEUART:
-    def __init__(self, ble, name=IAM, rxbuf=100):
+    def __init__(self, ble, name=IAM, rxbuf=100, mtu=247):
         self._ble = ble
         self._ble.active(True)
+        # MTU offered in the exchange, the central may settle on less
+        self._ble.config(mtu=mtu)
+        self.mtu = 23  # negotiated MTU, 23 until the central asks for more
         _, mac_address = self._ble.config('mac')
         formatted_mac = ':'.join(f'{b:02X}' for b in mac_address)
         print(f"Bluetooth MAC Address for this device is: {formatted_mac}")
@@ -56,7 +129,7 @@ class BLEUART:
         # Increase the size of the rx buffer and enable append mode.
         self._ble.gatts_set_buffer(self._rx_handle, rxbuf, True)
         self._connections = set()
-        self._rx_buffer = bytearray()
+        self._rx = RingBuffer(4 * rxbuf)
         self._handler = None
         # Optionally add services=[_UART_UUID], but this is likely to make the payload too large.
         self._payload = advertising_payload(name=name, appearance=_ADV_APPEARANCE_GENERIC_COMPUTER)
@@ -76,28 +149,65 @@ class BLEUART:
             if conn_handle in self._connections:
                 self._connections.remove(conn_handle)
             print(f"{IAM} disconnected")
+            if not self._connections:
+                self.mtu = 23
             # Start advertising again to allow a new connection.
             self._advertise()
         elif event == _IRQ_GATTS_WRITE:
             conn_handle, value_handle = data
             if conn_handle in self._connections and value_handle == self._rx_handle:
-                self._rx_buffer += self._ble.gatts_read(self._rx_handle)
+                self._rx.write(self._ble.gatts_read(self._rx_handle))
                 if self._handler:
                     self._handler()
+        elif event == _IRQ_MTU_EXCHANGED:
+            conn_handle, mtu = data
+            self.mtu = mtu
 
     def any(self):
-        return len(self._rx_buffer)
+        return self._rx.any()
 
     def read(self, sz=None):
+        # copy of the received bytes, readinto() or peek()/consume() do not allocate
         if not sz:
-            sz = len(self._rx_buffer)
-        result = self._rx_buffer[0:sz]
-        self._rx_buffer = self._rx_buffer[sz:]
+            sz = self._rx.any()
+        result = bytearray(min(sz, self._rx.any()))
+        self._rx.readinto(result)
         return result
 
+    def readinto(self, buf, n=None):
+        return self._rx.readinto(buf, n)
+
+    def peek(self):
+        return self._rx.peek()
+
+    def consume(self, n):
+        self._rx.consume(n)
+
+    def payload(self):
+        # data bytes one notification carries
+        return self.mtu - _ATT_HEADER
+
     def write(self, data):
-        for conn_handle in self._connections:
-            self._ble.gatts_notify(conn_handle, self._tx_handle, data)
+        # notifications of up to payload() bytes
+        mv = memoryview(data)
+        size = self.payload()
+        for i in range(0, len(mv), size):
+            self.send(mv[i:i + size])
+
+    def send(self, data):
+        """
+        One notification of data (at most payload() bytes) to every central.
+        Returns False if nobody is connected or the BLE stack has no room
+        for it now, nothing is queued
+        """
+        if not self._connections:
+            return False
+        try:
+            for conn_handle in self._connections:
+                self._ble.gatts_notify(conn_handle, self._tx_handle, data)
+        except OSError:
+            return False
+        return True
 
     def close(self):
         for conn_handle in self._connections:
@@ -0,0 +1,114 @@
+# dabble.py
+# Gamepad packets of the Dabble app
+
+from micropython import const
+
+HEADER = const(0xFF)
+GAMEPAD = const(0x01)  # module id
+DIGITAL = const(0x01)  # function ids of the gamepad modes
+JOYSTICK = const(0x02)
+ACCELEROMETER = const(0x03)
+END = const(0x00)
+EXTENDED = const(8)  # data bytes of an extended packet
+_MAX_DATA = const(8)
+
+
+class GamepadParser:
+    """
+    Incremental parser of gamepad packets:
+    0xFF 0x01 <function> <arguments> <data length> <data...> 0x00.
+    Bytes may come in any pieces, a bad byte drops the packet and the parser
+    looks for the next header from the byte after the dropped one's. Only the newest complete packet is kept:
+    function, buttons and value hold it, take() tells if it is not used yet.
+    An extended packet has 8 data bytes: buttons, value, sequence number
+    (uint16) and host time in ms (uint32), little-endian; seq is -1 for
+    the plain 2 byte ones
+    """
+
+    def __init__(self):
+        self._pos = 0  # byte of the packet expected next
+        self._size = 0  # data length of the packet being parsed
+        self._packet = bytearray(6 + _MAX_DATA)  # bytes of the packet being parsed
+        self._fresh = False
+        self.function = 0
+        self.buttons = 0
+        self.value = 0  # joystick: radius in bits 0..2, angle / 15 degrees in bits 3..7
+        self.seq = -1
+        self.stamp = 0
+        self.packets = 0  # complete packets
+        self.dropped = 0  # packets replaced by a newer one before take()
+        self.errors = 0  # packets broken off by a bad byte
+
+    def feed(self, data):
+        """
+        Parses the bytes of data, allocates nothing
+        """
+        for b in data:
+            self._byte(b)
+
+    def _byte(self, b):
+        pos = self._pos
+        if pos == 0:
+            if b == HEADER:
+                self._pos = 1
+            return
+        if pos == 1:
+            ok = b == GAMEPAD
+        elif pos == 2:
+            ok = DIGITAL <= b <= ACCELEROMETER
+        elif pos == 3:
+            ok = b == 1  # one argument
+        elif pos == 4:
+            ok = 0 < b <= _MAX_DATA
+            self._size = b
+        elif pos < 5 + self._size:
+            ok = True
+        else:
+            ok = b == END
+            if ok:
+                self._complete()
+                self._pos = 0
+                return
+        packet = self._packet
+        if ok:
+            packet[pos] = b
+            self._pos = pos + 1
+            return
+        self.errors += 1
+        # a packet may start anywhere after the header of the broken one: parse
+        # its bytes again. Packets found so far start later, so they only
+        # overwrite bytes of the buffer that are read already
+        self._pos = 0
+        for i in range(1, pos):
+            self._byte(packet[i])
+        self._byte(b)
+
+    def _complete(self):
+        self.packets += 1
+        if self._fresh:
+            self.dropped += 1
+        self._fresh = True
+        p = self._packet
+        self.function = p[2]
+        self.buttons = p[5]
+        self.value = p[6] if self._size > 1 else 0
+        if self._size >= EXTENDED:
+            self.seq = p[7] | p[8] << 8
+            self.stamp = p[9] | p[10] << 8 | p[11] << 16 | p[12] << 24
+        else:
+            self.seq = -1
+
+    def take(self):
+        """
+        Returns:
+            bool: True if a packet came since the last take()
+        """
+        fresh = self._fresh
+        self._fresh = False
+        return fresh
+
+    def stats(self):
+        """
+        Returns (packets, dropped, errors)
+        """
+        return self.packets, self.dropped, self.errors
@@ -0,0 +1,161 @@
+# gait.py
+# Gait cycles
+
+from array import array
+from collections import OrderedDict
+
+
+class GaitCache:
+    """
+    LRU of compiled gait cycles: joint frames of a whole cycle per command.
+    A cycle is only valid when the legs stand where it starts, so every entry
+    keeps that leg state too
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self._cycles = OrderedDict()  # key -> (leg state, frames), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, state):
+        entry = self._cycles.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._cycles[key] = entry
+        if entry[0] != state:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, state, frames):
+        """
+        Stores a copy of frames, reusing the buffer of an evicted cycle when possible
+        """
+        if self.size <= 0:
+            return
+        entry = self._cycles.pop(key, None)
+        if entry is None and len(self._cycles) >= self.size:
+            entry = self._cycles.pop(next(iter(self._cycles)))
+        if entry is not None and len(entry[1]) == len(frames):
+            buf = entry[1]
+            buf[:] = frames
+        else:
+            buf = array('h', frames)
+        self._cycles[key] = (state, buf)
+
+    def clear(self):
+        self._cycles = OrderedDict()
+
+
+class Gait:
+    """
+    Periodic gait: every leg spends duty of the cycle on the ground (stance)
+    and the rest in the air (swing), its cycle is shifted by offsets[leg]
+    """
+
+    def __init__(self, name, duty, offsets):
+        """
+        Args:
+            name (str): name of the gait
+            duty (float): stance part of the cycle
+            offsets (tuple): cycle shift of the legs 1..6, part of the cycle
+        """
+        self.name = name
+        self.duty = duty
+        self.offsets = offsets
+
+    def timing(self, swing_frames):
+        """
+        Integer timing of the gait for the given swing duration
+
+        Returns:
+            tuple: (frames of the cycle, stance frames, array of leg offsets in frames)
+        """
+        period = int(swing_frames / (1 - self.duty) + 0.5)
+        offsets = array('H', [int(o * period + 0.5) % period for o in self.offsets])
+        return period, period - swing_frames, offsets
+
+
+class Swing:
+    """
+    Foot path of a swing as two profiles by frame: progress 0..1 along the
+    stroke and lift 0..1 of the step height. The progress starts and ends with
+    zero speed, so the foot does not slide at lift-off and touch-down.
+    Profiles are tabulated once per frame count, a frame is a table lookup
+    """
+
+    def __init__(self, shape="bezier", progress=(0, 0, 1, 1), lift=(0, 4 / 3, 4 / 3, 0)):
+        """
+        Args:
+            shape (str): "bezier" - cubic Bezier curves of the control points below,
+                "minjerk" - minimum jerk progress, the lift goes up and down in minimum jerk halves
+            progress (tuple): 4 control points of the progress, bezier only
+            lift (tuple): 4 control points of the lift, bezier only. The default peaks at 1 in the middle
+        """
+        if shape not in ("bezier", "minjerk"):
+            raise ValueError("unknown swing shape: {}".format(shape))
+        self.shape = shape
+        self.progress = progress
+        self.lift = lift
+        self._tables = {}  # frames -> (progress, lift)
+
+    def table(self, frames):
+        """
+        Returns:
+            tuple: (progress, lift) arrays of frames + 1 values, by frame of the swing
+        """
+        tables = self._tables.get(frames)
+        if tables is not None:
+            return tables
+        progress = array('f', [0] * (frames + 1))
+        lift = array('f', [0] * (frames + 1))
+        p = self.progress
+        h = self.lift
+        for m in range(frames + 1):
+            t = m / frames
+            if self.shape == "bezier":
+                # cubic Bernstein basis
+                u = 1 - t
+                b0 = u * u * u
+                b1 = 3 * u * u * t
+                b2 = 3 * u * t * t
+                b3 = t * t * t
+                progress[m] = b0 * p[0] + b1 * p[1] + b2 * p[2] + b3 * p[3]
+                lift[m] = b0 * h[0] + b1 * h[1] + b2 * h[2] + b3 * h[3]
+            else:
+                progress[m] = _min_jerk(t)
+                lift[m] = _min_jerk(2 * t) if t < 0.5 else _min_jerk(2 - 2 * t)
+        # the foot ends exactly on the target
+        progress[frames] = 1
+        lift[frames] = 0
+        tables = (progress, lift)
+        self._tables[frames] = tables
+        return tables
+
+
+def _min_jerk(t):
+    # 0..1 in t = 0..1 with zero speed and acceleration at both ends
+    return t * t * t * (10 - 15 * t + 6 * t * t)
+
+
+# right side legs 3 (front), 2, 1 (back); left side 6 (front), 5, 4 (back), see IKEngine.outward().
+# Ripple and wave lift the legs of a side from the back to the front
+TRIPOD = Gait("tripod", 1 / 2, (0, 1 / 2, 0, 1 / 2, 0, 1 / 2))
+RIPPLE = Gait("ripple", 2 / 3, (0, 1 / 3, 2 / 3, 1 / 2, 5 / 6, 1 / 6))
+WAVE = Gait("wave", 5 / 6, (0, 1 / 6, 2 / 6, 3 / 6, 4 / 6, 5 / 6))
+GAITS = {gait.name: gait for gait in (TRIPOD, RIPPLE, WAVE)}
+
+
+def select(speed):
+    """
+    Gait for the joystick speed 0..7: the slow ones keep more legs on the ground
+    """
+    speed = abs(speed)
+    if speed <= 2:
+        return WAVE
+    if speed <= 4:
+        return RIPPLE
+    return TRIPOD
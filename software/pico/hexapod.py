@@ -1,55 +1,56 @@
 import asyncio
-import time
 import sys
+import time
 
 from machine import Pin, I2C
 import math
 
 i2c = I2C(0, sda=Pin(4), scl=Pin(5), freq=400000)
 from servo.servo import Servos
-
-
-def speed_divider(multiplier=1):
-    max_speed = 360  # 360ms for 180 degrees rotation. From the servo specification
-    rotation_range = 180
-    zero_speed = max_speed / 2  # zero speed
-    result_speed = (zero_speed * multiplier) / rotation_range
-    return result_speed
+from servo import calibration
+from motion import SlewTimer, FrameBuffer, ServoWorker, Scheduler
+from kinematics import IKEngine, IKCache
+from gait import GaitCache, GAITS, Swing, select
+from array import array
 
 
 class MotorDriver:
     max_speed = 360  # 360ms for 180 degrees rotation. From the servo specification
     rotation_range = 180
 
-    def __init__(self, driver_addr) -> None:
+    def __init__(self, driver_addr, calibration=None) -> None:
         self.driver_addr = driver_addr
-        self.driver = Servos(i2c=i2c, address=driver_addr)
+        # 2 table steps per degree: at 50 Hz PCA9685 has ~2 duty counts per degree anyway
+        self.driver = Servos(i2c=i2c, address=driver_addr, resolution=2, calibration=calibration)
+        self.pwm_period_us = int(self.driver.period)
+
+    def flush(self):
+        # send all rotations staged since the last flush as one I2C burst
+        self.driver.flush()
 
 
 class MotorSet:
     def __init__(self, driver, channel_id) -> None:
         self.driver = driver
         self.id = channel_id
+        self.angle = 900  # last commanded angle, 0.1 degree
 
     def rotation(self, angle):
-        self.driver.driver.position(index=self.id, degrees=angle)
+        # angle in 0.1 degree, staged only, MotorDriver.flush() sends the whole frame
+        self.driver.driver.position_fast(self.id, angle)
         # print(f"channel_id:  {self.id}\t rotation angle:  {angle}")
-        time.sleep_us(500)
-        #         return [f"motor_id {self.id}", angle]
-        pass
+        delta = angle - self.angle if angle > self.angle else self.angle - angle
+        self.angle = angle
+        return delta
 
 
 class Leg:
     def __init__(self, leg_id, motor_a: MotorSet, motor_b: MotorSet, motor_c: MotorSet, angle: int) -> None:
-        self.road_map = []
         self.rotation = 0
         self.leg_id = leg_id
         self.motor_a = motor_a
         self.motor_b = motor_b
         self.motor_c = motor_c
-        self.deviation_a = 0
-        self.deviation_b = 0
-        self.deviation_c = 0
         self.parts = 15  # quantity of steps
         self.X_Rest = 0  # zero position at x-axis
         self.Y_Rest = 50  # zero position at y-axis
@@ -59,82 +60,88 @@ class Leg:
         self.J3_rest = math.acos(((self.J2L * self.J2L) + (self.J3L * self.J3L) - (
                 (self.Y_Rest * self.Y_Rest) + (self.Z_Rest * self.Z_Rest))) / (2 * self.J2L * self.J3L)) * (
                                180 / math.pi)
-        self.old_coordinate = {"X": 0, "Y": 0, "Z": 0}
+        self.start = array('f', [0, 0, 0])  # X, Y, Z where the current step starts
+        self.target = array('f', [0, 0, 0])  # X, Y, Z where the current step ends
+        self.old_coordinate = array('f', [0, 0, 0])  # X, Y, Z of the foot now, see track()
+        self.swing = False  # the leg is in the air during the current step
+        self.lift = 1  # part of the step height the swing still rises, see track()
+        self.segment = -1  # gait segment of the current step: 0 - stance, 1 - swing
+        self.plan_idx = 0  # frame of the segment the current step was planned at
         self.angle = angle
 
-    def drive(self):
-        for q in self.road_map:
-            x = q[0]
-            y = q[1]
-            w = q[2]
-            self.motor_a.rotation(x)
-            self.motor_b.rotation(y)
-            self.motor_c.rotation(w)
-            yield {f"{self.leg_id}:a": x,
-                   f"{self.leg_id}:b": y,
-                   f"{self.leg_id}:c": w}
-
-    def _cartesian_move(self, X, Y, Z, yaw):
-        angle = self.angle - yaw
-        # OFFSET TO REST POSITION
-        Z = -Z
-        Z += self.Z_Rest
-        X = -X if self.leg_id in [4, 2, 6] else X
-        Y = self.Y_Rest + X * math.sin(math.radians(angle))
-        X = X * math.cos(math.radians(angle))
-
-        # CALCULATE INVERSE KINEMATIC SOLUTION
-        J1 = math.atan(X / Y) * (180 / math.pi)
-        H = math.sqrt((Y * Y) + (X * X))
-        L = math.sqrt((H * H) + (Z * Z))
-        J3 = math.acos(((self.J2L * self.J2L) + (self.J3L * self.J3L) - (L * L)) / (2 * self.J2L * self.J3L)) * (180 / math.pi)
-        J3_result = 2 * self.J3_rest - J3
-        B = math.acos(((L * L) + (self.J2L * self.J2L) - (self.J3L * self.J3L)) / (2 * L * self.J2L)) * (180 / math.pi)
-        A = math.atan(Z / H) * (180 / math.pi)  # BECAUSE Z REST IS NEGATIVE, THIS RETURNS A NEGATIVE VALUE
-        J2 = (B + A)  # BECAUSE 'A' IS NEGATIVE AT REST WE NEED TO INVERT '-' TO '+'
-        if self.leg_id in [1, 2, 3]:  # left side
-            return J1 + 90 + self.deviation_a, 90 + J2 + self.deviation_b, 90 + J3_result + self.deviation_c
-        else:  # right side
-            return J1 + 90 + self.deviation_a, 90 - J2 + self.deviation_b, 90 - J3_result + self.deviation_c
-
-    def wave_move(self, X, Y, Z, yaw):
-        self.road_map = []
-
-        part = 180 / self.parts
-        X_part = (self.old_coordinate["X"] - X) / self.parts
-        Y_part = (self.old_coordinate["Y"] - Y) / self.parts
-
-        for i in range(self.parts + 1):
-            _x = self.old_coordinate["X"] - X_part * i
-            _y = self.old_coordinate["Y"] + Y_part * i
-            if self.old_coordinate["X"] > X:
-                _z = Hexapod.up_ * math.sin(math.radians(i * part))
-            else:
-                _z = Z
-            self.road_map.append(self._cartesian_move(_x, _y, _z, yaw))
-        self.old_coordinate = {"X": X, "Y": Y, "Z": Z}
+    def wave_move(self, X, Y, Z):
+        # a new step from where the foot is now, Hexapod solves it frame by frame
+        old = self.old_coordinate
+        self.start[0] = old[0]
+        self.start[1] = old[1]
+        self.start[2] = old[2]
+        self.target[0] = X
+        self.target[1] = Y
+        self.target[2] = Z
+
+    def track(self, k, z_lift):
+        """
+        Moves old_coordinate to the fraction k of the current step (progress
+        of the swing profile for a swing leg, see gait.Swing), a swing leg
+        is raised by z_lift times self.lift on top of that. A step that begins
+        in the air (cut short, see Hexapod.tick()) gets only the rest of the
+        lift, so the foot comes down without a jump or a dip
+        """
+        pos = self.old_coordinate
+        start = self.start
+        target = self.target
+        if k >= 1:
+            pos[0] = target[0]
+            pos[1] = target[1]
+            z = target[2]
+        else:
+            pos[0] = start[0] + (target[0] - start[0]) * k
+            pos[1] = start[1] + (target[1] - start[1]) * k
+            z = start[2] + (target[2] - start[2]) * k
+        if self.swing and self.lift > 0:
+            z += z_lift * self.lift
+        pos[2] = z
 
 
 class Hexapod:
-    h_step = 15
+    h_step = 15  # longest half stride, mm
     up_ = -15
-
-    def __init__(self) -> None:
+    speed_levels = 7  # joystick speed is 0..7
+    # feet at rest in the body frame, mm
+    length = 95.8  # between the front and the back feet
+    width = 71.7  # between the middle feet
+    inset = 7  # front and back feet are that much closer to the body axis
+
+    def __init__(self, dual_core=False, ik_cache=0, gait_cache=4, stream=False, rate_hz=0, gait=None,
+                 swing="bezier") -> None:
         self.motor_angles = {}
         self._rotation = 0
         self.angle = 30
+        # servo trims and non-linearity, see calibration.json
+        servo_calibration = calibration.load()
         try:
-            self.driver_1 = MotorDriver(0x40)
+            self.driver_1 = MotorDriver(0x40, servo_calibration.get(0x40))
         except Exception as e:
             self.driver_1 = None
             print(f"Servo driver 1: {e}")
         try:
-            self.driver_2 = MotorDriver(0x41)
+            self.driver_2 = MotorDriver(0x41, servo_calibration.get(0x41))
         except Exception as e:
             self.driver_2 = None
             print(f"Servo driver 2: {e}")
         if self.driver_1 is None or self.driver_2 is None:
             sys.exit(-1)
+        safety = 1.2  # margin of the servo speed for load and voltage sag
+        if rate_hz:
+            # fixed frame rate, background work goes to self.timer.background():
+            # it runs while a frame waits for its slot, single core only
+            self.timer = Scheduler(rate_hz)
+            frame_us = self.timer.period_us
+        else:
+            # frames are paced by the servo speed
+            self.timer = SlewTimer(MotorDriver.max_speed, MotorDriver.rotation_range,
+                                   safety=safety, min_period_us=self.driver_1.pwm_period_us)
+            frame_us = self.driver_1.pwm_period_us
 
         self.speed_multiplier = 0
         self.roll = 0  # kren
@@ -143,146 +150,492 @@ class Hexapod:
 
         self.leg_1 = Leg(1, MotorSet(self.driver_1, 4), MotorSet(self.driver_1, 5), MotorSet(self.driver_1, 6),
                          angle = 180 +self.angle)  # ok
-        self.leg_1.deviation_a = 0
-        self.leg_1.deviation_b = -15
-        self.leg_1.deviation_c = -20
 
         self.leg_2 = Leg(2, MotorSet(self.driver_1, 8), MotorSet(self.driver_1, 9), MotorSet(self.driver_1, 10),
                          angle = 0)  # ok
-        self.leg_2.deviation_a = 7
-        self.leg_2.deviation_b = -23
-        self.leg_2.deviation_c = -14
 
         self.leg_3 = Leg(3, MotorSet(self.driver_1, 12), MotorSet(self.driver_1, 13), MotorSet(self.driver_1, 14),
                          angle = 120 +self.angle)  # ok
-        self.leg_3.deviation_a = 0
-        self.leg_3.deviation_b = -23
-        self.leg_3.deviation_c = -8
 
         self.leg_4 = Leg(4, MotorSet(self.driver_2, 15), MotorSet(self.driver_2, 14), MotorSet(self.driver_2, 13),
                          angle = 120 +self.angle)  # ok
-        self.leg_4.deviation_a = 10
-        self.leg_4.deviation_b = 20
-        self.leg_4.deviation_c = -5
 
         self.leg_5 = Leg(5, MotorSet(self.driver_2, 11), MotorSet(self.driver_2, 10), MotorSet(self.driver_2, 9),
                          angle = 0)  # ok
-        self.leg_5.deviation_a = 10
-        self.leg_5.deviation_b = 5
-        self.leg_5.deviation_c = 7
 
         self.leg_6 = Leg(6, MotorSet(self.driver_2, 7), MotorSet(self.driver_2, 6), MotorSet(self.driver_2, 5),
                          angle = 180 +self.angle)  # ok
-        self.leg_6.deviation_a = 0
-        self.leg_6.deviation_b = 17
-        self.leg_6.deviation_c = 25
-
-    def _step_left(self, step, angle):
-        x = -1 if self._rotation else 1
 
-        self.leg_1.wave_move(step[0], 0, 0, angle)
-        self.leg_5.wave_move(step[1], 0, 0, angle)
-        self.leg_3.wave_move(step[2], 0, 0, x*angle)
-
-        self.leg_4.wave_move(-step[0], 0, 0, angle)
-        self.leg_2.wave_move(-step[1], 0, 0, angle)
-        self.leg_6.wave_move(-step[2], 0, 0, x*angle)
-
-    def _step_right(self, step, angle):
-        x = -1 if self._rotation else 1
-
-        self.leg_1.wave_move(-step[0], 0, 0, angle)
-        self.leg_5.wave_move(-step[1], 0, 0, angle)
-        self.leg_3.wave_move(-step[2], 0, 0, x*angle)
-
-        self.leg_4.wave_move(step[0], 0, 0, angle)
-        self.leg_2.wave_move(step[1], 0, 0, angle)
-        self.leg_6.wave_move(step[2], 0, 0, x*angle)
-        
-    
+        self.legs = [self.leg_1, self.leg_2, self.leg_3, self.leg_4, self.leg_5, self.leg_6]
+        self.motors = []
+        for leg in self.legs:
+            self.motors += [leg.motor_a, leg.motor_b, leg.motor_c]
+        # joint frame: a, b, c angles of legs 1..6 in 0.1 degree
+        self.frame = array('h', [0] * len(self.motors))
+        # ik.cache.stats() tells how well ik_cache entries are used
+        self.ik = IKEngine(self.legs, IKCache(ik_cache) if ik_cache else None)
+        # feet at rest in the body frame: x forward, y to the right, from the body centre.
+        # A foot sits on the side and at the end its leg reaches out to, see IKEngine.outward()
+        x, y = self.length / 2, self.width / 2
+        self.feet_x = array('f', [0] * len(self.legs))
+        self.feet_y = array('f', [0] * len(self.legs))
+        for l in range(len(self.legs)):
+            ox, oy = self.ik.outward(l)
+            end = 0 if abs(ox) < 0.1 else (1 if ox > 0 else -1)
+            self.feet_x[l] = end * x
+            self.feet_y[l] = (y - self.inset if end else y) * (1 if oy > 0 else -1)
+        self.radius = max(math.sqrt(self.feet_x[l] ** 2 + self.feet_y[l] ** 2) for l in range(len(self.legs)))
+        # half stroke of every leg in the body frame: stance ends at +stroke, swing at -stroke
+        self.stroke_x = array('f', [0] * len(self.legs))
+        self.stroke_y = array('f', [0] * len(self.legs))
+        self._check_feet()
+        # foot path of a swing: "bezier" or "minjerk"
+        self.swing_path = Swing(swing)
+        # "tripod", "ripple", "wave" or None to pick one by speed
+        self.gait = GAITS[gait] if gait else None
+        # stride and swing frames of every speed level
+        self._cadence(frame_us, MotorDriver.max_speed * 1000 / MotorDriver.rotation_range * safety)
+        self.swing_frames = 0  # frames a leg spends in the air at the current speed
+        self._gait = None  # gait being walked
+        self._switch = None  # gait to change to once the feet are down, see plan()
+        self._timing = None  # its (frames of the cycle, stance frames, leg offsets)
+        self._n = 0  # phase clock: frame of the gait cycle
+        period = max(g.timing(max(self.swings))[0] for g in GAITS.values())
+        # joint frames of the current cycle, recorded for the cache
+        self.cycle = array('h', [0] * (period * len(self.motors)))
+        # recorded cycles of the recent commands, 1-3 KB each
+        self.gaits = GaitCache(gait_cache)
+        # solve every frame, never record or replay cycles in self.gaits; a new
+        # command cuts the cycle either way, see tick()
+        self.stream = stream
+        self._command = None  # latest body velocity (vx, vy, wz) from command() or drive()
+        self._tag = None  # tag of the latest command until a frame carries it
+        self.on_applied = None  # callable(tag, frame, us), see command()
+        self._echo = None  # tag whose frame is not output yet, see _report()
+        self._mark = 0  # number of that frame
+        self._mark_us = 0  # ticks_us when it was output, set by _output()
+        self._key = None  # body velocity being walked
+        self._left = 0  # frames left in the current cycle, see begin()
+        # frames sent and the time between the last two, for telemetry
+        self.frame_count = 0
+        self._published = 0  # frames handed over to _output(), ahead of frame_count on two cores
+        self.frame_us = 0
+        self._sent_us = time.ticks_us()
+        self.frames = None
+        if dual_core:
+            # core 1 owns I2C and the servo pacing, core 0 only computes frames
+            self.frames = FrameBuffer(len(self.motors))
+            self.worker = ServoWorker(self.frames, self._output)
+            self.worker.start()
+
+    def _cadence(self, frame_us, us_per_degree):
+        """
+        Fills self.strides (half stride, mm) and self.swings (frames of a swing)
+        of every speed level. The top level swings in as few frames as the servos
+        follow at one frame per frame_us: no frame of the swing profile moves a
+        joint further than a servo turns in frame_us, so its speed is set by the
+        servo slew.
+        Lower levels take more frames (up to Leg.parts) and shorter strides:
+        the body speed grows in proportion to the level. The stride of a level is
+        set by the stance frames of the gait it walks (see gait.select()), a slow
+        gait swings faster where its longest stride would fall short; a level
+        the gait does not reach even then walks at the top speed of that gait
+        """
+        step = self.h_step
+        while step > 0 and not self._reachable(step):
+            step -= 1
+        self.reach = step  # longest half stride every leg reaches, mm
+        fastest = 4
+        while self._swing_move(step, fastest) * us_per_degree > frame_us:
+            fastest += 1
+        self.fastest = fastest  # fewest frames of a swing over the longest stride
+        slowest = max(fastest, self.leg_1.parts)
+        levels = self.speed_levels
+        self.strides = array('f', [0] * (levels + 1))
+        self.swings = array('B', [slowest] * (levels + 1))
+        # ground speed of the top level, mm per frame
+        top = 2 * step / (self.gait or select(levels)).timing(fastest)[1]
+        for level in range(1, levels + 1):
+            f = level / levels
+            gait = self.gait or select(level)
+            frames = min(slowest, int(fastest / math.sqrt(f) + 0.5))
+            while frames > fastest and top * f * gait.timing(frames)[1] / 2 > step:
+                frames -= 1
+            self.swings[level] = frames
+            self.strides[level] = min(step, top * f * gait.timing(frames)[1] / 2)
+
+    def _check_feet(self):
+        """
+        A turn in place must be a rotation of the body: every stroke tangential,
+        the legs of the two sides mirror each other along their reach axes.
+        Raises ValueError when the feet and the leg geometry disagree
+        """
+        self._stroke(0, 0, 1, self.h_step)
+        n = len(self.legs)
+        for l in range(n):
+            fx, fy = self.feet_x[l], self.feet_y[l]
+            sx, sy = self.stroke_x[l], self.stroke_y[l]
+            ox, oy = self.ik.outward(l)
+            if abs(sx * fx + sy * fy) > 1e-3 or fx * ox + fy * oy <= 0:
+                raise ValueError("leg {}: foot off its reach axis".format(self.legs[l].leg_id))
+            for m in range(n):
+                mx, my = self.ik.outward(m)
+                if self.feet_x[m] == fx and self.feet_y[m] == -fy and abs(mx - ox) < 1e-3 and abs(my + oy) < 1e-3:
+                    if abs(abs(sx * ox + sy * oy) - abs(self.stroke_x[m] * mx + self.stroke_y[m] * my)) > 1e-3:
+                        raise ValueError("legs {} and {}: turn is not symmetric".format(
+                            self.legs[l].leg_id, self.legs[m].leg_id))
+                    break
+            else:
+                raise ValueError("leg {}: no mirrored leg".format(self.legs[l].leg_id))
+
+    def _reachable(self, step):
+        # every leg reaches the half stride step in any direction, on the ground and lifted
+        for l in range(len(self.legs)):
+            for a in range(0, 360, 45):
+                x = step * math.cos(math.radians(a))
+                y = step * math.sin(math.radians(a))
+                for z in (0, self.up_):
+                    if not self.ik.reachable(l, x, y, z):
+                        return False
+        return True
+
+    def _swing_move(self, step, frames):
+        # degrees the busiest joint moves in the busiest frame of a swing over
+        # frames, half stride step forward, sideways or turning
+        out = array('h', [0] * 3)
+        last = array('h', [0] * 3)
+        progress, lift = self.swing_path.table(frames)
+        self._stroke(0, 0, 1, step)
+        move = 0
+        for l in range(len(self.legs)):
+            for dx, dy in ((step, 0), (0, step), (self.stroke_x[l], self.stroke_y[l])):
+                for m in range(frames + 1):
+                    k = 2 * progress[m] - 1
+                    self.ik.solve(l, dx * k, dy * k, self.up_ * lift[m], out, 0)
+                    if m:
+                        move = max(move, max(abs(out[j] - last[j]) for j in range(3)))
+                    for j in range(3):
+                        last[j] = out[j]
+        return move / 10
+
+    def _level(self, speed):
+        return min(int(abs(speed)), self.speed_levels)
+
+    def _stroke(self, vx, vy, wz, step):
+        """
+        Stroke of every foot for the body velocity: a stance foot moves with
+        the ground, (vx, vy) plus the turn wz around the body centre. The
+        fastest foot gets the half stride step, the others keep their ratio
+        """
+        sx = self.stroke_x
+        sy = self.stroke_y
+        fastest = 0
+        for l in range(len(self.legs)):
+            sx[l] = vx - wz * self.feet_y[l] / self.radius
+            sy[l] = vy + wz * self.feet_x[l] / self.radius
+            fastest = max(fastest, math.sqrt(sx[l] * sx[l] + sy[l] * sy[l]))
+        k = step / fastest if fastest else 0
+        for l in range(len(self.legs)):
+            sx[l] *= k
+            sy[l] *= k
 
     def _speed(self, speed):
-        self.speed_multiplier = math.fabs(speed)
-
-    def _move(self):
-        l2 = self.leg_2.drive()
-        l1 = self.leg_1.drive()
-        l3 = self.leg_3.drive()
-        l4 = self.leg_4.drive()
-        l5 = self.leg_5.drive()
-        l6 = self.leg_6.drive()
-        while True:
-            try:
-                next(l1)
-                next(l2)
-                next(l3)
-                next(l4)
-                next(l5)
-                next(l6)
-            except Exception as e:
-                print(e)
-                break
+        # part of the top speed
+        self.speed_multiplier = self._level(speed) / self.speed_levels
+
+    def _output(self, frame):
+        delta = 0
+        motors = self.motors
+        for i in range(len(motors)):
+            d = motors[i].rotation(frame[i])
+            if d > delta:
+                delta = d
+        self.timer.pace(delta / 10)
+        now = time.ticks_us()
+        self.frame_us = time.ticks_diff(now, self._sent_us)
+        self._sent_us = now
+        if self.frame_count + 1 == self._mark:
+            self._mark_us = now
+        self.frame_count += 1
+        self.driver_1.flush()
+        self.driver_2.flush()
+
+    def _back_frame(self):
+        # the frame to fill for the next tick
+        return self.frame if self.frames is None else self.frames.back()
+
+    async def _emit(self):
+        if self.frames is None:
+            # the event loop runs while the frame waits for its time slot,
+            # _output() sleeps the sub-millisecond rest
+            await asyncio.sleep_ms(max(0, self.timer.due_us()) // 1000)
+            self._published += 1
+            self._output(self.frame)
+            return
+        while not self.frames.publish():
+            await asyncio.sleep_ms(1)
+        self._published += 1
+
+    def _advance(self, out, replan):
+        """
+        Moves the feet one frame along the gait and solves them into out
+        (None only tracks the feet). A leg plans a new step from where its foot
+        is when it enters a stance or a swing, or on replan
+        """
+        period, stance, offsets = self._timing
+        n = self._n
+        table = self.swing_path.table
+        legs = self.legs
+        for l in range(len(legs)):
+            leg = legs[l]
+            psi = (n - offsets[l]) % period
+            if psi < stance:
+                segment, idx, length = 0, psi, stance
+            else:
+                segment, idx, length = 1, psi - stance, period - stance
+            if segment != leg.segment or replan:
+                x = self.stroke_x[l]
+                y = self.stroke_y[l]
+                old = leg.old_coordinate
+                left = length - idx
+                if segment:
+                    leg.wave_move(-x, -y, 0)
+                elif idx:
+                    # re-planned in the middle of the stance: the foot goes on with the
+                    # ground at the new velocity, as far as the legs reach
+                    tx = old[0] + 2 * x * left / length
+                    ty = old[1] + 2 * y * left / length
+                    r = math.sqrt(tx * tx + ty * ty)
+                    k = self.reach / r if r > self.reach else 1
+                    leg.wave_move(tx * k, ty * k, 0)
+                else:
+                    leg.wave_move(x, y, 0)
+                # a foot off its target steps there, on a stop too: a foot in the
+                # air always comes down along the swing profile
+                leg.swing = segment == 1 and (old[0] != -x or old[1] != -y or old[2] != 0)
+                leg.lift = 1 - old[2] / Hexapod.up_  # the rest of the lift
+                late = 2 * left < length or left < self.fastest
+                if leg.swing and (late or self._switch is not None and old[2] == 0):
+                    # too late to step over, or a new gait waits for the feet to come
+                    # down: a foot on the ground waits there for its stance, a foot
+                    # in the air lands where it is
+                    leg.wave_move(old[0], old[1], 0)
+                    leg.swing = old[2] != 0
+                    leg.lift = 0  # past the top already, it only comes down
+                leg.segment = segment
+                leg.plan_idx = idx
+            m = idx + 1 - leg.plan_idx  # frames of the step done
+            if leg.swing:
+                # profile of the frames the swing was planned for
+                progress, lift = table(length - leg.plan_idx)
+                leg.track(progress[m], Hexapod.up_ * lift[m])
+            else:
+                leg.track(m / (length - leg.plan_idx), 0)
+                if leg.start[2] != 0:
+                    # re-planned into the stance in the air: lands within a swing,
+                    # not over the whole stance
+                    frames = min(self.swing_frames, length - leg.plan_idx)
+                    leg.old_coordinate[2] = leg.start[2] * (1 - table(frames)[0][min(m, frames)])
+            if out is not None:
+                pos = leg.old_coordinate
+                self.ik.solve(l, pos[0], pos[1], pos[2], out, 3 * l)
+        self._n = (n + 1) % period
+
+    def _airborne(self):
+        for leg in self.legs:
+            if leg.old_coordinate[2] != 0:
+                return True
+        return False
+
+    def _state(self):
+        state = []
+        for leg in self.legs:
+            state += leg.old_coordinate
+        return tuple(state)
+
+    def _velocity(self, speed, angle):
+        """
+        Body velocity (vx, vy, wz) of the joystick speed 0..7 and angle (degrees
+        clockwise from forward), parts of the top speed. In rotation mode the
+        side part of the stick turns the body instead of walking sideways
+        """
+        f = self._level(speed) / self.speed_levels
+        a = math.radians(angle)
+        if self._rotation:
+            return f * math.cos(a), 0, f * math.sin(a)
+        return f * math.cos(a), f * math.sin(a), 0
+
+    def command(self, speed, angle, tag=None):
+        """
+        Latest command of the remote control, the cycle being walked is cut
+        short after the current frame when it differs. on_applied(tag, frame, us)
+        is called with the number of the first frame sent with the command in
+        effect and the ticks_us it was output at; a tag replaced by a newer one
+        before that is never reported
+        """
+        self._tag = tag
+        self._command = self._velocity(speed, angle)
+
+    def drive(self, vx, vy, wz, tag=None):
+        """
+        Same as command() for a body velocity, see plan()
+        """
+        self._tag = tag
+        self._command = (vx, vy, wz)
+
+    def _report(self):
+        # echoes the tagged command once its frame is output, on core 1 that is
+        # after publish(): frame_count and _mark_us come from _output()
+        if self._echo is not None and self.frame_count >= self._mark:
+            tag = self._echo
+            self._echo = None
+            if self.on_applied is not None:
+                self.on_applied(tag, self._mark, self._mark_us)
+
+    def begin(self, speed=1, angle=0):
+        """
+        Starts a gait cycle of the joystick command, see plan()
+        """
+        print(f"HexaPod.move(speed={speed}, angle={angle})")
+        self.plan(*self._velocity(speed, angle))
+
+    def plan(self, vx, vy, wz=0):
+        """
+        Starts a gait cycle of the body velocity from where the feet are now,
+        its frames are sent one by one by tick(). Any mix of walking, crab
+        walking and turning works the same way
+
+        Args:
+            vx (float): forward velocity, part of the top speed -1..1
+            vy (float): velocity to the right, part of the top speed -1..1
+            wz (float): clockwise turn, the farthest foot moves at the top speed at 1
+        """
+        level = self._level(min(1, math.sqrt(vx * vx + vy * vy + wz * wz)) * self.speed_levels + 0.5)
+        self._speed(level)
+        key = (vx, vy, wz)
+        # a new command re-plans all legs from where they are
+        self._replan = key != self._key
+        self._key = key
+        self._stroke(vx, vy, wz, self.strides[level])
+        gait = self.gait or select(level)
+        self._switch = None
+        if self._gait is not None and gait is not self._gait and self._airborne():
+            # the feet in the air land in the old gait first, no new swing starts
+            # until then (see _advance()), tick() ends the cycle when they are down
+            self._switch = gait
+            gait = self._gait
+        # faster levels swing in fewer frames
+        swing = self.swings[level]
+        if gait is not self._gait or swing != self.swing_frames:
+            timing = gait.timing(swing)
+            if self._timing is not None:  # same point of the cycle in the new timing
+                self._n = self._n * timing[0] // self._timing[0]
+            self._gait = gait
+            self.swing_frames = swing
+            self._timing = timing
+            self._replan = True
+        self._left = self._timing[0]
+        self._cached = None
+        self._blended = self._replan or self._switch is not None  # a blended cycle is not cached
+        if self.stream or self._blended:
+            return
+        # a cycle is recorded once and replayed from the cache while the command repeats
+        self._cache_key = key + (gait.name, self._n)
+        self._cache_state = self._state()
+        self._cached = self.gaits.get(self._cache_key, self._cache_state)
+
+    async def tick(self):
+        """
+        Sends the next frame of the cycle started by begin(), the event loop
+        runs while the frame waits for its time slot. A command() different
+        from the one being walked ends the cycle after this frame, the next
+        begin() blends from where the feet are
+
+        Returns:
+            bool: False when the cycle is over and nothing was sent
+        """
+        if self._left <= 0:
+            return False
+        frame = self._back_frame()
+        size = len(frame)
+        o = (self._timing[0] - self._left) * size
+        cycle = self._cached
+        if cycle is not None:
+            self._advance(None, False)
+            for j in range(size):
+                frame[j] = cycle[o + j]
+        else:
+            # unreachable feet are clamped into the workspace, see IKEngine._clamp()
+            self._advance(frame, self._replan)
+            if not self.stream:
+                cycle = self.cycle
+                for j in range(size):
+                    cycle[o + j] = frame[j]
+        if self._tag is not None and self._echo is None and self._command == self._key:
+            # this frame carries the tagged command
+            self._echo = self._tag
+            self._tag = None
+            self._mark = self._published + 1
+        await self._emit()
+        self._report()
+        self._left -= 1
+        if (self._left == 0 and self._cached is None and not self.stream and not self._blended
+                and self._state() == self._cache_state):
+            # steady cycle, legs end where it starts: it can be replayed
+            self.gaits.put(self._cache_key, self._cache_state, self.cycle[:o + size])
+        if o == 0:
+            self._replan = False
+        if self._command is not None and self._command != self._key:
+            self._left = 0
+        if self._switch is not None and not self._airborne():
+            self._left = 0  # the next plan() changes the gait
+        return True
 
     async def move(self, speed=1, angle=0):
-        self._speed(speed)
-        step = self.h_step if self.speed_multiplier != 0 else 0
         if speed == 0:
             await asyncio.sleep(0.5)
             print("idle")
-        if self.rotation:
-            
-            radius = 30
-            a = 10 # step of low central leg
-            _angle = math.degrees(2*math.asin(a/(2*radius)))
-            aa = 7
-            bb = 95.8
-            ad = 71.7
-            od = radius + ad
-            ob = math.sqrt(math.pow((bb/2),2) + math.pow((radius+aa),2))
-            oc = math.sqrt(math.pow((bb/2),2) + math.pow((od-aa),2))
-            
-            b = (ob*a)/radius
-            c = (oc*a)/radius
-            d = (od*a)/radius
-            # print(a,b,c,d,"::",angle)
-            if 0 <= angle <= 90:
-                side = "r"
-            elif -260 <= angle < -180:
-                print(":: ROTATION :: back right", _angle)
-                side = "r"
-                _angle -= 180 
-            elif -180 <= angle < -90:
-                print(":: ROTATION :: back left", _angle)
-                _angle = -_angle -180
-                side = "l"
+        self.begin(speed, angle)
+        while await self.tick():
+            pass
+
+    async def follow(self):
+        """
+        Walks the latest command() or drive() for ever. Every cycle starts from
+        one snapshot of it, a newer one cuts the cycle short (see tick())
+        """
+        idle = False
+        while True:
+            velocity = self._command or (0, 0, 0)
+            if velocity == (0, 0, 0):
+                if idle:  # feet are down already
+                    self._report()
+                    if self._tag is not None and self._echo is None:
+                        # nothing to move, in effect at once
+                        self._echo = self._tag
+                        self._tag = None
+                        self._mark = self._published
+                        self._mark_us = time.ticks_us()
+                        self._report()
+                    await asyncio.sleep_ms(20)
+                    continue
+                idle = True
             else:
-                side = "l"
-                _angle = -_angle
-            # right
-            if side == "r":
-                
-                sl = [c, a, c]
-                sr = [b, d, b]
-            # left
-            elif side == "l":
-                sl = [b, d, b]
-                sr = [c, a, c]
-            angle = _angle
-            print(a,b,c,d,"::",angle)
-        else:
-            print(f"HexaPod.move(speed={speed}, angle={angle})")
-            sl = [step, step, step]
-            sr = [step, step, step]
+                idle = False
+            self.plan(*velocity)
+            while await self.tick():
+                pass
 
-                
-        self._step_left(sl, angle)
-        self._move()
-        await asyncio.sleep(0.1)
-        
-        self._step_right(sr, angle)
-        self._move()
-        await asyncio.sleep(0.1)
+    async def walk(self, vx, vy, wz=0):
+        # one gait cycle at the body velocity, see plan()
+        self.plan(vx, vy, wz)
+        while await self.tick():
+            pass
 
+    @property
+    def velocity(self):
+        # body velocity (vx, vy, wz) being walked, see plan()
+        return self._key or (0, 0, 0)
 
     @property
     def rotation(self):
@@ -307,11 +660,11 @@ async def main():
     print("move")
     await _hex.move(speed=0, angle=0)
     print("sleep")
-    time.sleep(3)
+    await asyncio.sleep(3)
 
     while 1:
-        await  _hex.move(speed=1, angle=0)
-        time.sleep(0.5)
+        await  _hex.move(speed=7, angle=0)
+        await asyncio.sleep(0.5)
 
 
 if __name__ == "__main__":
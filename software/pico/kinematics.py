@@ -0,0 +1,320 @@
+# kinematics.py
+# Inverse kinematics of all legs at once
+
+from array import array
+from collections import OrderedDict
+import math
+
+RAD2DEG = 180 / math.pi
+
+
+class IKCache:
+    """
+    Fixed-size LRU cache of leg solutions keyed on the quantized foot position.
+    Solutions live in one preallocated array, the budget is 6 bytes per entry
+    plus the dict
+    """
+
+    def __init__(self, size=256, quantum=0.5):
+        """
+        Args:
+            size (int): entries
+            quantum (float): mm, foot positions closer than that share a solution
+        """
+        self.size = size
+        self.quantum = quantum
+        self._slots = OrderedDict()  # key -> slot, least recently used first
+        self._angles = array('h', [0] * (3 * size))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, geometry, qx, qy, qz):
+        """
+        Small int key of the quantized position, None past +-127 quanta:
+        such positions are solved without the cache
+        """
+        if not (-128 < qx < 128 and -128 < qy < 128 and -128 < qz < 128):
+            return None
+        return (geometry << 24) | ((qx & 0xFF) << 16) | ((qy & 0xFF) << 8) | (qz & 0xFF)
+
+    def get(self, key, out, o):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            self.misses += 1
+            return False
+        self._slots[key] = slot  # most recently used now
+        self.hits += 1
+        a = self._angles
+        s = 3 * slot
+        out[o] = a[s]
+        out[o + 1] = a[s + 1]
+        out[o + 2] = a[s + 2]
+        return True
+
+    def put(self, key, out, o):
+        if len(self._slots) < self.size:
+            slot = len(self._slots)
+        else:
+            slot = self._slots.pop(next(iter(self._slots)))
+            self.evictions += 1
+        self._slots[key] = slot
+        a = self._angles
+        s = 3 * slot
+        a[s] = out[o]
+        a[s + 1] = out[o + 1]
+        a[s + 2] = out[o + 2]
+
+    def clear(self):
+        self._slots = OrderedDict()
+
+    def stats(self):
+        """
+        Returns (hits, misses, evictions, entries in use)
+        """
+        return self.hits, self.misses, self.evictions, len(self._slots)
+
+
+class IKEngine:
+    """
+    Solves the legs into a joint frame (a, b, c angles in 0.1 degree per leg).
+    Geometry of every leg is hoisted into arrays at construction,
+    so solving touches no dicts, lists or tuples. Mirrored legs (1 and 6,
+    2 and 5, 3 and 4) share one solution of their geometry class
+    """
+
+    def __init__(self, legs, cache=None):
+        n = len(legs)
+        self.count = n
+        self.y_rest = array('f', [leg.Y_Rest for leg in legs])
+        self.z_rest = array('f', [leg.Z_Rest for leg in legs])
+        self.mount = array('f', [leg.angle for leg in legs])
+        # law of cosines constants
+        self.c_j3 = array('f', [leg.J2L * leg.J2L + leg.J3L * leg.J3L for leg in legs])
+        self.k_j3 = array('f', [2 * leg.J2L * leg.J3L for leg in legs])
+        self.c_b = array('f', [leg.J2L * leg.J2L - leg.J3L * leg.J3L for leg in legs])
+        self.k_b = array('f', [2 * leg.J2L for leg in legs])
+        self.j3_rest2 = array('f', [2 * leg.J3_rest for leg in legs])
+        # X axis of the legs 2, 4, 6 is inverted; right side joints b, c are mirrored
+        self.flip = array('b', [-1 if leg.leg_id in (2, 4, 6) else 1 for leg in legs])
+        self.side = array('b', [1 if leg.leg_id in (1, 2, 3) else -1 for leg in legs])
+        # foot moves of the body frame turned into the leg frame
+        self.sin = array('f', [math.sin(math.radians(leg.angle)) for leg in legs])
+        self.cos = array('f', [math.cos(math.radians(leg.angle)) for leg in legs])
+        # legs with the same constants but mirrored (flip, side) form a geometry class:
+        # the class is solved once for the target turned by flip, side mirrors b and c
+        geometry = {}
+        self.geometry = array('B', [0] * n)
+        for i in range(n):
+            constants = (self.y_rest[i], self.z_rest[i], self.mount[i], self.c_j3[i], self.k_j3[i],
+                         self.c_b[i], self.k_b[i], self.j3_rest2[i])
+            self.geometry[i] = geometry.setdefault(constants, len(geometry))
+        self.classes = len(geometry)
+        # last solution of every class: target X, Y, Z and angles J1, B + A, J3 from rest
+        self._last = array('f', [float('nan')] * (6 * self.classes))
+        self._angles = array('h', [0] * 3)  # cached class solution, 0.1 degree
+        self._target = array('f', [0] * 3)  # target in the leg frame, see _clamp()
+        self.cache = cache
+        self.solved = 0  # class solutions computed
+        self.mirrored = 0  # leg solutions taken from the last one of the class
+        self.clamped = 0  # targets moved into the workspace
+        self._workspace(legs)
+
+    def _workspace(self, legs, z_step=2):
+        """
+        Reachable workspace of every geometry class by rows of the foot height
+        in the leg frame: the squared horizontal distance from the hip between
+        h_min2 and h_max2. The row covers z_step mm, its bounds hold over all of
+        it and keep joints b and c inside the servo range
+        """
+        reach = max(leg.J2L + leg.J3L for leg in legs)
+        self.z_step = z_step
+        self.z0 = -reach  # height of row 0
+        self.rows = rows = int(2 * reach / z_step) + 1
+        self.h_min2 = array('f', [0] * (self.classes * rows))
+        self.h_max2 = array('f', [0] * (self.classes * rows))
+        self.row_lo = array('H', [rows] * self.classes)  # first row with a reachable point
+        self.row_hi = array('H', [0] * self.classes)
+        done = set()
+        for i in range(len(legs)):
+            c = self.geometry[i]
+            if c in done:
+                continue
+            done.add(c)
+            # leg length range of the law of cosines, a little inside for rounding
+            long2 = ((legs[i].J2L + legs[i].J3L) * 0.999) ** 2
+            short2 = ((legs[i].J2L - legs[i].J3L) * 1.001) ** 2
+            for row in range(rows):
+                z = self.z0 + row * z_step
+                near = max(0, abs(z) - z_step / 2)  # height of the row closest to and farthest from the hip
+                far = abs(z) + z_step / 2
+                hi = math.sqrt(max(0, long2 - far * far))
+                lo = math.sqrt(max(1, short2 - near * near))
+                hi = self._edge(i, hi, lo, z, z_step)
+                lo = self._edge(i, lo, hi, z, z_step)
+                if lo >= hi:
+                    continue
+                r = c * rows + row
+                self.h_min2[r] = lo * lo
+                self.h_max2[r] = hi * hi
+                self.row_lo[c] = min(self.row_lo[c], row)
+                self.row_hi[c] = max(self.row_hi[c], row)
+
+    def _edge(self, i, h, stop, z, z_step):
+        # first distance from h toward stop where the servos follow all over the row:
+        # 4 mm steps, then back in 0.5 mm steps
+        step = 4 if stop > h else -4
+        start = h
+        while (h - stop) * step < 0 and not self._row_ok(i, h, z, z_step):
+            h += step
+        if (h - stop) * step >= 0:
+            return stop
+        while h != start and self._row_ok(i, h - step / 8, z, z_step):
+            h -= step / 8
+        return h
+
+    def _row_ok(self, i, H, z, z_step):
+        return self._servo_ok(i, H, z - z_step / 2) and self._servo_ok(i, H, z + z_step / 2)
+
+    def _servo_ok(self, i, H, Z):
+        # joints b and c of the leg i stay within 0..180 degrees for either side
+        if H <= 0:
+            return False
+        LL = H * H + Z * Z
+        L = math.sqrt(LL)
+        a = (self.c_j3[i] - LL) / self.k_j3[i]
+        b = (LL + self.c_b[i]) / (L * self.k_b[i])
+        if not (-1 <= a <= 1 and -1 <= b <= 1):
+            return False
+        J3 = math.acos(a) * RAD2DEG
+        BA = math.acos(b) * RAD2DEG + math.atan(Z / H) * RAD2DEG
+        return abs(BA) <= 90 and abs(self.j3_rest2[i] - J3) <= 90
+
+    def outward(self, i):
+        """
+        Returns:
+            tuple: (x, y) of the body frame the leg i reaches out along, the Y axis of its leg frame
+        """
+        f = self.flip[i]
+        return f * self.sin[i], -f * self.cos[i]
+
+    def reachable(self, i, X, Y, Z):
+        """
+        True if the leg i reaches (X, Y, Z) without clamping, see solve()
+        """
+        return not self._clamp(i, X * self.flip[i], Y * self.flip[i], Z)
+
+    def _clamp(self, i, X, Y, Z):
+        """
+        Moves the target (X, Y, Z turned by flip) of the leg i into its workspace:
+        to the nearest reachable height, then along the line from the hip.
+        Leaves the target in the leg frame (X, Y, Z) in self._target
+
+        Returns:
+            bool: True if the target was moved
+        """
+        Z = self.z_rest[i] - Z
+        X, Y = X * self.cos[i] + Y * self.sin[i], self.y_rest[i] + X * self.sin[i] - Y * self.cos[i]
+        c = self.geometry[i]
+        moved = False
+        row = int((Z - self.z0) / self.z_step + 0.5)
+        if row < self.row_lo[c] or row > self.row_hi[c]:
+            row = self.row_lo[c] if row < self.row_lo[c] else self.row_hi[c]
+            Z = self.z0 + row * self.z_step
+            moved = True
+        if Y < 1:  # the foot stays in front of the hip
+            Y = 1
+            moved = True
+        r = c * self.rows + row
+        HH = X * X + Y * Y
+        if HH > self.h_max2[r] or HH < self.h_min2[r]:
+            k = math.sqrt((self.h_max2[r] if HH > self.h_max2[r] else self.h_min2[r]) / HH)
+            X *= k
+            Y *= k
+            moved = True
+        target = self._target
+        target[0] = X
+        target[1] = Y
+        target[2] = Z
+        return moved
+
+    def solve(self, i, X, Y, Z, out, o):
+        """
+        Writes joint angles of the leg i with foot at (X, Y, Z) from the rest
+        position into out[o], out[o + 1], out[o + 2]. X is forward and Y is
+        to the right in the body frame, Z is down
+        """
+        flip = self.flip[i]
+        X *= flip
+        Y *= flip
+        cache = self.cache
+        if cache is None:
+            self._solve(i, X, Y, Z, out, o)
+            return
+        q = cache.quantum
+        qx = int(round(X / q))
+        qy = int(round(Y / q))
+        qz = int(round(Z / q))
+        key = cache.key(self.geometry[i], qx, qy, qz)
+        if key is None:
+            self._solve(i, X, Y, Z, out, o)
+            return
+        angles = self._angles
+        if not cache.get(key, angles, 0):
+            # solve the quantized position, so a hit and a miss give the same answer
+            last = self._last
+            s = 6 * self.geometry[i]
+            self._class(i, qx * q, qy * q, qz * q)
+            angles[0] = int(last[s + 3] * 10)
+            angles[1] = int(last[s + 4] * 10)
+            angles[2] = int(last[s + 5] * 10)
+            cache.put(key, angles, 0)
+        side = self.side[i]
+        out[o] = 900 + angles[0]
+        out[o + 1] = 900 + side * angles[1]
+        out[o + 2] = 900 + side * angles[2]
+
+    def _solve(self, i, X, Y, Z, out, o):
+        # X, Y turned by flip already: legs of a class with the same target
+        # share the solution, only the side differs
+        last = self._last
+        s = 6 * self.geometry[i]
+        if last[s] == X and last[s + 1] == Y and last[s + 2] == Z:
+            self.mirrored += 1
+        else:
+            self._class(i, X, Y, Z)
+        side = self.side[i]
+        out[o] = int((90 + last[s + 3]) * 10)
+        out[o + 1] = int((90 + side * last[s + 4]) * 10)
+        out[o + 2] = int((90 + side * last[s + 5]) * 10)
+
+    def _class(self, i, X, Y, Z):
+        # solution of the geometry class of the leg i into self._last,
+        # an unreachable target is solved at the nearest reachable point
+        last = self._last
+        s = 6 * self.geometry[i]
+        last[s] = X
+        last[s + 1] = Y
+        last[s + 2] = Z
+
+        # OFFSET TO REST POSITION, INSIDE THE WORKSPACE
+        if self._clamp(i, X, Y, Z):
+            self.clamped += 1
+        target = self._target
+        X = target[0]
+        Y = target[1]
+        Z = target[2]
+
+        # CALCULATE INVERSE KINEMATIC SOLUTION
+        J1 = math.atan(X / Y) * RAD2DEG
+        HH = Y * Y + X * X
+        H = math.sqrt(HH)
+        LL = HH + Z * Z
+        L = math.sqrt(LL)
+        J3 = math.acos((self.c_j3[i] - LL) / self.k_j3[i]) * RAD2DEG
+        B = math.acos((LL + self.c_b[i]) / (L * self.k_b[i])) * RAD2DEG
+        A = math.atan(Z / H) * RAD2DEG  # BECAUSE Z REST IS NEGATIVE, THIS RETURNS A NEGATIVE VALUE
+        last[s + 3] = J1
+        last[s + 4] = B + A
+        last[s + 5] = self.j3_rest2[i] - J3
+        self.solved += 1
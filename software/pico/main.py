@@ -2,9 +2,12 @@ import aioble
 import bluetooth
 from machine import ADC
 import asyncio
+import time
 
 from hexapod import Hexapod
 from ble_uart import BLEUART
+from dabble import GamepadParser, JOYSTICK
+from telemetry import Telemetry
 
 # ADC Channel 4 reads the temperature sensor
 sensor_temp = ADC(4)
@@ -16,6 +19,11 @@ SQUARE = 32
 CIRCLE = 8
 SELECT = 2
 START = 1
+DUAL_CORE = False  # servo output on the second core
+IK_CACHE = 0  # entries of the IK solutions cache, 0 disables it
+STREAM = False  # never record and replay gait cycles (see GaitCache), every frame is solved
+RATE_HZ = 0  # fixed frame rate of the gait, 0 paces frames by the servo speed
+TELEMETRY_HZ = 10  # telemetry records per second, 0 disables telemetry
 
 
 # Function to read the internal temperature
@@ -31,53 +39,68 @@ message_count = 0
 
 # Init HexaPod
 print("Init Hexapod")
-_hex = Hexapod()
+_hex = Hexapod(dual_core=DUAL_CORE, ik_cache=IK_CACHE, stream=STREAM, rate_hz=RATE_HZ)
 _hex.move(speed=0, angle=0)
-speed = 0
-angle = 0
 
 
 async def hex_move():
-    global speed, angle
+    # walks the latest command, see receive()
+    await _hex.follow()
+
+
+async def receive(uart, received):
+    # packets may come split or several at once, only the newest one is used
+    parser = GamepadParser()
+    mode = 0
     while True:
-        await _hex.move(speed, angle)
-        await asyncio.sleep(0)
+        await received.wait()
+        while uart.any():
+            chunk = uart.peek()
+            parser.feed(chunk)
+            uart.consume(len(chunk))
+        if not parser.take():
+            continue
+        if parser.function != mode:
+            mode = parser.function
+            print('Joystic Mode' if mode == JOYSTICK else 'Digital Mode is NOT SUPPORTED')
+        if mode != JOYSTICK:
+            continue
+        btn = parser.buttons
+        if btn & TRIANGLE:
+            print("TRIANGLE is pressed")
+            _hex.rotation = 1
+        else:
+            _hex.rotation = 0
+
+        radius_n_angle = parser.value
+        speed = radius_n_angle & 0x07
+        angle = -((radius_n_angle >> 3) * 15 - 90)
+        # one snapshot of the command, the gait picks it up at its next frame;
+        # an extended packet is echoed with the frame it took effect at
+        tag = (parser.seq, parser.stamp, time.ticks_us()) if parser.seq >= 0 else None
+        _hex.command(speed, angle, tag)
+
+        print("buttons: ", btn, "radius_n_angle: ", speed, angle, "packets, dropped, errors: ", parser.stats())
 
 
 async def run_peripheral_mode():
     ble = bluetooth.BLE()
     uart = BLEUART(ble)
 
-    def on_rx():
-        global speed, angle, TRIANGLE
-        msg = uart.read()
-        if b'\xff\x01\x02\x01\x02' in msg:
-            print('Joystic Mode')
-        if b'\xff\x01\x01\x01\x02' in msg:
-            print('Digital Mode is NOT SUPPORTED')
-            return
-        try:
-            btn = msg[5]
-            if btn & TRIANGLE:
-                print("TRIANGLE is pressed")
-                _hex.rotation = 1
-            else:
-                _hex.rotation = 0
-            
-            radius_n_angle = msg[6]
-            speed = radius_n_angle & 0x07
-            angle = -((radius_n_angle >> 3) * 15 - 90)
-
-            print("buttons: ", btn, "radius_n_angle: ", speed, angle)
-        except Exception:
-            print(msg)
-
-    uart.irq(handler=on_rx)
+    # the BLE IRQ only raises the flag, receive() decodes in the event loop
+    received = asyncio.ThreadSafeFlag()
+    uart.irq(handler=received.set)
+    asyncio.create_task(receive(uart, received))
+    telemetry = Telemetry(uart, _hex, rate_hz=TELEMETRY_HZ, temperature=read_temperature)
+    _hex.on_applied = telemetry.echo
+    if RATE_HZ and not DUAL_CORE:
+        # records are sampled in the slack of the fixed-rate frames
+        _hex.timer.background(telemetry.poll)
+    else:
+        asyncio.create_task(telemetry.run())
 
     try:
-        while True:
-            await hex_move()
-            await asyncio.sleep(1)
+        await hex_move()
     except KeyboardInterrupt:
         pass
 
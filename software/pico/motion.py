@@ -0,0 +1,197 @@
+# motion.py
+# Frame pacing of the servo output
+
+from array import array
+import _thread
+import time
+
+
+class SlewTimer:
+    """
+    Paces servo frames to the shortest period the servos can follow:
+    the largest joint move of a frame must be finished before the next one is sent
+    """
+
+    def __init__(self, max_speed=360, rotation_range=180, safety=1.2, min_period_us=20000):
+        """
+        Args:
+            max_speed (int): ms the servo needs for rotation_range degrees, from the servo specification
+            rotation_range (int): degrees
+            safety (float): multiplier of the theoretical period, >= 1 leaves margin for load and voltage sag
+            min_period_us (int): floor of the period, one PWM period: the servo never sees frames faster than that
+        """
+        self.us_per_degree = max_speed * 1000 / rotation_range
+        self.safety = safety
+        self.min_period_us = min_period_us
+        self._deadline = time.ticks_us()
+
+    def period_us(self, delta):
+        """
+        Shortest period of a frame whose largest joint move is delta degrees
+        """
+        return max(self.min_period_us, int(delta * self.us_per_degree * self.safety))
+
+    def due_us(self):
+        """
+        Microseconds until the next frame may be sent
+        """
+        return time.ticks_diff(self._deadline, time.ticks_us())
+
+    def pace(self, delta):
+        """
+        Blocks until the previous frame is physically done, then arms the timer
+        for the frame about to be sent (delta degrees of the largest joint move)
+        """
+        wait = time.ticks_diff(self._deadline, time.ticks_us())
+        if wait > 0:
+            time.sleep_us(wait)
+        self._deadline = time.ticks_add(time.ticks_us(), self.period_us(delta))
+
+
+class FrameBuffer:
+    """
+    Double-buffered joint frame shared by two cores: the producer fills back(),
+    the consumer owns the front one between take() and release()
+    """
+
+    def __init__(self, size):
+        self._buffers = (array('h', [0] * size), array('h', [0] * size))
+        self._back = 0
+        self._lock = _thread.allocate_lock()
+        self._fresh = False  # front holds a frame not taken yet
+        self._busy = False  # consumer is still reading the front one
+
+    def back(self):
+        return self._buffers[self._back]
+
+    def publish(self):
+        """
+        Hands back() over to the consumer. Returns False (nothing done) while
+        the previous frame is not consumed, the producer should retry
+        """
+        with self._lock:
+            if self._fresh or self._busy:
+                return False
+            self._back ^= 1
+            self._fresh = True
+            return True
+
+    def take(self):
+        """
+        Returns the newest published frame or None
+        """
+        with self._lock:
+            if not self._fresh:
+                return None
+            self._fresh = False
+            self._busy = True
+            return self._buffers[self._back ^ 1]
+
+    def release(self):
+        with self._lock:
+            self._busy = False
+
+
+class ServoWorker:
+    """
+    Servo output loop on the second core of RP2040: takes frames from
+    a FrameBuffer and passes them to output(frame)
+    """
+
+    def __init__(self, frames, output, idle_us=200):
+        self.frames = frames
+        self.output = output
+        self.idle_us = idle_us
+        self.running = False
+
+    def start(self):
+        self.running = True
+        _thread.start_new_thread(self._run, ())
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        frames = self.frames
+        while self.running:
+            frame = frames.take()
+            if frame is None:
+                time.sleep_us(self.idle_us)
+                continue
+            try:
+                self.output(frame)
+            finally:
+                frames.release()
+
+
+class Scheduler:
+    """
+    Fixed-rate pacing of the control loop by ticks_us deadlines: one frame per
+    tick, deadlines do not drift with the time spent computing frames.
+    Non-real-time work registered with background() runs in the slack of a tick,
+    from due_us() only: pace() may run on the servo core (see ServoWorker) and
+    never calls it
+    """
+
+    def __init__(self, rate_hz=50):
+        self.period_us = 1000000 // rate_hz
+        self._deadline = None  # the schedule starts with the first tick
+        self._tasks = []  # [callable, budget_us]
+        self._next_task = 0
+        self._slack_tick = -1  # tick whose slack was used already
+        self.ticks = 0
+        self.overruns = 0  # ticks that started after their deadline
+        self.max_late_us = 0
+
+    def background(self, task, budget_us=2000):
+        """
+        Registers task() to be called when a tick has at least budget_us of slack.
+        Tasks take turns, one per tick at most
+        """
+        self._tasks.append([task, budget_us])
+
+    def due_us(self):
+        """
+        Microseconds until the next tick. Runs a background task first
+        if the slack allows it
+        """
+        if self._deadline is None:
+            return 0
+        self._slack()
+        return time.ticks_diff(self._deadline, time.ticks_us())
+
+    def _slack(self):
+        if not self._tasks or self._slack_tick == self.ticks:
+            return
+        task = self._tasks[self._next_task]
+        if time.ticks_diff(self._deadline, time.ticks_us()) >= task[1]:
+            self._slack_tick = self.ticks
+            self._next_task = (self._next_task + 1) % len(self._tasks)
+            task[0]()
+
+    def pace(self, delta=0):
+        """
+        Blocks until the deadline of the next tick, delta (largest joint move)
+        is ignored: the rate is fixed
+        """
+        self.ticks += 1
+        if self._deadline is None:
+            self._deadline = time.ticks_us()
+        late = time.ticks_diff(time.ticks_us(), self._deadline)
+        if late > 0:
+            self.overruns += 1
+            if late > self.max_late_us:
+                self.max_late_us = late
+            if late > self.period_us:
+                # too late to catch up, start a new schedule from now
+                self._deadline = time.ticks_us()
+        wait = time.ticks_diff(self._deadline, time.ticks_us())
+        if wait > 0:
+            time.sleep_us(wait)
+        self._deadline = time.ticks_add(self._deadline, self.period_us)
+
+    def stats(self):
+        """
+        Returns (ticks, overruns, max_late_us)
+        """
+        return self.ticks, self.overruns, self.max_late_us
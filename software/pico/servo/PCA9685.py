@@ -55,6 +55,23 @@ class PCA9685:
         data = ustruct.pack('<HH', on, off)
         self.i2c.writeto_mem(self.address, 0x06 + 4 * index,  data)
 
+    def pwm_block(self, start, data):
+        """
+        Writes ON/OFF registers of several consecutive channels in one
+        I2C transaction, relying on register auto-increment (enabled in freq())
+
+        Args:
+            start (int): first channel of the block
+            data (bytes-like): 4 bytes ('<HH' on, off) per channel
+        """
+        self.i2c.writeto_mem(self.address, 0x06 + 4 * start, data)
+
+    def pwm_block_read(self, start, buf):
+        """
+        Reads ON/OFF registers of len(buf) // 4 consecutive channels into buf
+        """
+        self.i2c.readfrom_mem_into(self.address, 0x06 + 4 * start, buf)
+
     def duty(self, index, value=None, invert=False):
         if value is None:
             pwm = self.pwm(index)
@@ -0,0 +1,27 @@
+# calibration.py
+# Loads per-channel servo calibration points
+
+import json
+
+
+def load(path="calibration.json"):
+    """
+    Reads the calibration file:
+        {"0x40": {"4": [[0, 450], [90, 1330], [180, 2250]], ...}, ...}
+    i.e. driver address -> channel -> measured (degrees, us) points
+
+    Returns:
+        dict: {address (int): {channel (int): [(degrees, us), ...]}},
+        empty if the file does not exist
+    """
+    try:
+        with open(path) as f:
+            raw = json.load(f)
+    except OSError:
+        print(f"Calibration file {path} not found, linear servo mapping is used")
+        return {}
+    result = {}
+    for address, channels in raw.items():
+        result[int(address, 16)] = {int(channel): [tuple(p) for p in points]
+                                    for channel, points in channels.items()}
+    return result
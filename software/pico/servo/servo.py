@@ -3,12 +3,16 @@
 # March 2021
 
 from servo.PCA9685 import PCA9685
+from array import array
+import ustruct
 import math
 
+CHANNELS = 16
+
 
 class Servos:
     def __init__(self, i2c, address=0x40, freq=50, min_us=600, max_us=2400,
-                 degrees=180):
+                 degrees=180, resolution=10, calibration=None):
         self.period = 1000000 / freq
         self.min_duty = self._us2duty(min_us)
         self.max_duty = self._us2duty(max_us)
@@ -16,11 +20,24 @@ class Servos:
         self.freq = freq
         self.pca9685 = PCA9685(i2c, address)
         self.pca9685.freq(freq)
+        # shadow copy of the ON/OFF registers of all channels, read once at start
+        self._frame = bytearray(4 * CHANNELS)
+        self._frame_mv = memoryview(self._frame)
+        self.pca9685.pwm_block_read(0, self._frame)
+        self._dirty = 0  # bit mask of channels changed since the last flush
+        self.max_gap = 1  # clean channels rewritten to join two dirty ranges
+        # clamped duty for every 1/resolution degree of the range, see position_fast()
+        self.resolution = resolution
+        table = array('H', (self._duty(degrees=d / resolution) for d in range(resolution * degrees + 1)))
+        self._tables = [table] * CHANNELS
+        if calibration:
+            for index, points in calibration.items():
+                self.calibrate(index, points)
 
     def _us2duty(self, value):
         return int(4095 * value / self.period)
 
-    def position(self, index, degrees=None, radians=None, us=None, duty=None):
+    def _duty(self, degrees=None, radians=None, us=None, duty=None):
         span = self.max_duty - self.min_duty
         if degrees is not None:
             duty = self.min_duty + span * degrees / self.degrees
@@ -28,12 +45,123 @@ class Servos:
             duty = self.min_duty + span * radians / math.radians(self.degrees)
         elif us is not None:
             duty = self._us2duty(us)
-        elif duty is not None:
-            pass
+        return min(self.max_duty, max(self.min_duty, int(duty)))
+
+    def calibrate(self, index, points):
+        """
+        Replaces the linear angle-to-duty mapping of one channel with a piecewise
+        linear one going through the measured points
+
+        Args:
+            index (int): channel
+            points (list): (degrees, us) pairs, at least two. Angles out of
+            the measured range are extrapolated from the nearest segment
+        """
+        points = sorted(points)
+        if len(points) < 2:
+            raise ValueError("At least two calibration points are required")
+        table = array('H', self._tables[index])
+        segment = 0
+        for d in range(len(table)):
+            degrees = d / self.resolution
+            while segment < len(points) - 2 and degrees > points[segment + 1][0]:
+                segment += 1
+            (a0, us0), (a1, us1) = points[segment], points[segment + 1]
+            us = us0 + (us1 - us0) * (degrees - a0) / (a1 - a0)
+            table[d] = min(self.max_duty, max(self.min_duty, self._us2duty(us)))
+        self._tables[index] = table
+
+    def _stage_duty(self, index, value):
+        if value == 0:
+            on, off = 0, 4096
+        elif value == 4095:
+            on, off = 4096, 0
         else:
-            return self.pca9685.duty(index)
-        duty = min(self.max_duty, max(self.min_duty, int(duty)))
-        self.pca9685.duty(index, duty)
+            on, off = 0, value
+        f = self._frame
+        o = 4 * index
+        if (f[o] == on & 0xFF and f[o + 1] == on >> 8
+                and f[o + 2] == off & 0xFF and f[o + 3] == off >> 8):
+            return  # the chip already has it
+        f[o] = on & 0xFF
+        f[o + 1] = on >> 8
+        f[o + 2] = off & 0xFF
+        f[o + 3] = off >> 8
+        self._dirty |= 1 << index
+
+    def _shadow_duty(self, index):
+        on, off = ustruct.unpack_from('<HH', self._frame, 4 * index)
+        if off == 4096:
+            return 0
+        if on == 4096:
+            return 4095
+        return off
+
+    def stage(self, index, degrees=None, radians=None, us=None, duty=None):
+        """
+        Puts a new position of the channel into the frame buffer.
+        Nothing is sent to the chip until flush() is called
+        """
+        self._stage_duty(index, self._duty(degrees, radians, us, duty))
+
+    def position_fast(self, index, decidegrees):
+        """
+        Integer version of stage(index, degrees=decidegrees / 10): a lookup in
+        the precomputed (calibrated) duty table of the channel, no float math
+        and no allocation. Takes effect on the next flush()
+        """
+        table = self._tables[index]
+        d = decidegrees * self.resolution // 10
+        if d < 0:
+            d = 0
+        elif d >= len(table):
+            d = len(table) - 1
+        self._stage_duty(index, table[d])
+
+    def flush(self):
+        """
+        Sends changed channels to the chip, one auto-increment write per
+        contiguous dirty range. Ranges separated by no more than max_gap clean
+        channels are merged: rewriting a few bytes is cheaper than a new
+        I2C transaction
+        """
+        dirty = self._dirty
+        if not dirty:
+            return
+        mv = self._frame_mv
+        i = 0
+        while dirty >> i:
+            if not (dirty >> i) & 1:
+                i += 1
+                continue
+            j = i + 1
+            while dirty >> j:
+                if (dirty >> j) & 1:
+                    j += 1
+                elif (dirty >> j) & ((2 << self.max_gap) - 1):
+                    j += 1  # short gap before the next dirty channel
+                else:
+                    break
+            self.pca9685.pwm_block(i, mv[4 * i:4 * j])
+            i = j
+        self._dirty = 0
+
+    def positions(self, frame, start=0):
+        """
+        Moves several channels at once: frame[i] is the angle in degrees of
+        channel start + i (None leaves the channel untouched)
+        """
+        for i, degrees in enumerate(frame):
+            if degrees is not None:
+                self.stage(start + i, degrees=degrees)
+        self.flush()
+
+    def position(self, index, degrees=None, radians=None, us=None, duty=None):
+        if degrees is None and radians is None and us is None and duty is None:
+            return self._shadow_duty(index)
+        self.stage(index, degrees, radians, us, duty)
+        self.flush()
 
     def release(self, index):
-        self.pca9685.duty(index, 0)
\ No newline at end of file
+        self._stage_duty(index, 0)
+        self.flush()
@@ -0,0 +1,139 @@
+# telemetry.py
+# Binary telemetry over the BLE UART
+
+import asyncio
+import math
+import struct
+import time
+
+from micropython import const
+
+MAGIC = const(0x5AA5)
+# magic, record number, ms, frame period us, frames sent, 18 joint angles (0.1 degree),
+# vx, vy, wz (1/1000 of the top speed), roll, pitch, yaw (0.1 degree), temperature (0.01 C)
+RECORD = "<HHHHH18h3h3hh"
+RECORD_SIZE = struct.calcsize(RECORD)
+ECHO_MAGIC = const(0x5AA6)
+# magic, sequence number and host ms of the command, frame it was applied at, ms from receipt to that frame
+ECHO = "<HHIHH"
+ECHO_SIZE = struct.calcsize(ECHO)
+
+
+class Telemetry:
+    """
+    Packs fixed-size little-endian records (see RECORD) of the robot state
+    into one reusable buffer and sends them as a byte stream: a notification
+    goes out only when it can be filled up to the negotiated MTU. A record
+    starts with MAGIC, so the receiver can find the records again after a
+    lost notification. When the link is congested the batch is dropped,
+    a full buffer drops new records: nothing is queued.
+    Echoes of extended commands (see echo()) go into the same stream
+    and are sent at once
+    """
+
+    def __init__(self, uart, hexapod, rate_hz=10, imu=None, temperature=None, size=512):
+        """
+        Args:
+            uart (BLEUART): link to send on
+            hexapod (Hexapod): source of the joint angles, velocity and loop timing
+            rate_hz (int): records per second, 0 sends echoes only
+            imu (MPU6050): attitude source, None takes roll, pitch, yaw of the hexapod
+            temperature (callable): returns degrees C, None sends 0
+            size (int): bytes of the batch buffer, at least one MTU
+        """
+        self.uart = uart
+        self.hexapod = hexapod
+        self.period_ms = 1000 // rate_hz if rate_hz else 0
+        self.imu = imu
+        self.temperature = temperature
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._fill = 0  # bytes waiting in the buffer
+        self._seq = 0
+        self._due = time.ticks_ms()  # next record of poll()
+        self.sent = 0  # notifications
+        self.dropped = 0  # bytes lost to a full buffer or a congested link
+
+    def _attitude(self):
+        if self.imu is None:
+            h = self.hexapod
+            return h.roll, h.pitch, h.yaw
+        ax, ay, az = self.imu.accel.xyz
+        roll = math.degrees(math.atan2(ay, az))
+        pitch = math.degrees(math.atan2(-ax, math.sqrt(ay * ay + az * az)))
+        return roll, pitch, 0
+
+    def sample(self):
+        """
+        Packs one record of the current state into the buffer
+        """
+        if self._fill + RECORD_SIZE > len(self._buf):
+            self.dropped += RECORD_SIZE
+            return
+        h = self.hexapod
+        m = h.motors
+        vx, vy, wz = h.velocity
+        roll, pitch, yaw = self._attitude()
+        temperature = self.temperature() if self.temperature else 0
+        struct.pack_into(RECORD, self._buf, self._fill, MAGIC, self._seq, time.ticks_ms() & 0xFFFF,
+                         min(h.frame_us, 0xFFFF), h.frame_count & 0xFFFF,
+                         m[0].angle, m[1].angle, m[2].angle, m[3].angle, m[4].angle, m[5].angle,
+                         m[6].angle, m[7].angle, m[8].angle, m[9].angle, m[10].angle, m[11].angle,
+                         m[12].angle, m[13].angle, m[14].angle, m[15].angle, m[16].angle, m[17].angle,
+                         int(vx * 1000), int(vy * 1000), int(wz * 1000),
+                         int(roll * 10), int(pitch * 10), int(yaw * 10), int(temperature * 100))
+        self._seq = (self._seq + 1) & 0xFFFF
+        self._fill += RECORD_SIZE
+
+    def echo(self, tag, frame, us):
+        """
+        Hexapod.on_applied of the commands tagged (seq, host ms, ticks_us at receipt),
+        frame was output at ticks_us us
+        """
+        if self._fill + ECHO_SIZE > len(self._buf):
+            self.dropped += ECHO_SIZE
+            return
+        seq, stamp, received = tag
+        age = min(max(0, time.ticks_diff(us, received)) // 1000, 0xFFFF)
+        struct.pack_into(ECHO, self._buf, self._fill, ECHO_MAGIC, seq, stamp, frame & 0xFFFF, age)
+        self._fill += ECHO_SIZE
+        self.flush(True)
+
+    def flush(self, partial=False):
+        """
+        Sends every full notification of the buffer, the rest waits for more
+        records unless partial
+        """
+        size = self.uart.payload()
+        done = 0
+        while self._fill - done >= size or (partial and self._fill > done):
+            n = min(size, self._fill - done)
+            if not self.uart.send(self._mv[done:done + n]):
+                # congested or not connected: the batch is stale by the next try
+                self.dropped += self._fill - done
+                self._fill = 0
+                return
+            self.sent += 1
+            done += n
+        if done:
+            rest = self._fill - done
+            self._buf[:rest] = self._mv[done:self._fill]
+            self._fill = rest
+
+    def poll(self):
+        """
+        Scheduler.background() task, called once a frame: sends a record when it is due
+        """
+        if not self.period_ms or time.ticks_diff(time.ticks_ms(), self._due) < 0:
+            return
+        self._due = time.ticks_add(time.ticks_ms(), self.period_ms)
+        self.sample()
+        self.flush()
+
+    async def run(self):
+        if not self.period_ms:
+            return
+        while True:
+            self.sample()
+            self.flush()
+            await asyncio.sleep_ms(self.period_ms)